@@ -1,39 +1,88 @@
+import io
+import subprocess
 import numpy as np
+from collections import defaultdict, deque
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache
+from itertools import repeat
 
 from hwgen import *
-from computationcoding.csd_conv import to_csd
+from csd import to_csd_batch
+# the numba kernel is None if numba is not available, the numpy version is used then
+from csd_conv_nb import extract_shifts_from_mats
 
 
-def get_shifts(n, w, d):
+@lru_cache(maxsize=1 << 16)
+def _csd_cached(n_fixed, wd, w):
+    """Cached CSD conversion of a single fix point number.
+    Factor matrices usually contain many repeated (power-of-two) entries,
+    so the conversion is done only once per distinct value.
+
+    :n_fixed: fix point representation of the number (n * 2**(w-wd) as integer)
+    :wd: number of integer bits
+    :w: total bit width
+    :returns: tuple of shifts in form (positions, sign)
+
+    """
+    csd = to_csd_batch([n_fixed / (1 << (w-wd))], wd, w)[0]
+    return tuple((wd-i-1, bool(x > 0)) for i, x in enumerate(csd) if x != 0)
+
+
+SHIFT_DTYPE = np.dtype([("y", np.int64), ("x", np.int64), ("s", np.int64), ("positive", np.bool_)])
+
+
+def get_shifts(M, w, d):
     """Helper function to generate minimal set of required shifts for
-    multiplication of a given fixed point.
+    multiplication with all nonzero entries of a fix point matrix.
 
-    :n: input float number
+    :M: input matrix (np.array of floats)
     :w: total bit width
     :d: number of decimal bits
-    :returns: list of shifts in form (positions, sign)
+    :returns: structured array of shifts with fields (y: row, x: column, s: shift positions, positive: sign)
 
     """
+    assert w >= d, "number of decimal bits exceeds the bit width"
+    ys, xs = np.nonzero(M)
     shifts = []
-    w = 20
-    w = 160
-    d = 80
-    csd = to_csd(n, w-d, w)
-    # --> csd = [ 0. -1.  0. -1.  0.  0.  0.  0.  0.  0.]
-    for i, x in enumerate(csd):
-        if x != 0:
-            s = w-d-i-1
-            shifts.append((s, x>0))
-    return shifts
-
-
-def gen_fblock(M, W, D, name_postfix=""):
+    for y, x, n in zip(ys.tolist(), xs.tolist(), M[ys, xs].tolist()):
+        for s, positive in _csd_cached(int(round(n * (1 << d))), w-d, w):
+            shifts.append((y, x, s, positive))
+    return np.array(shifts, dtype=SHIFT_DTYPE)
+
+
+def _build_accs(M, W, D):
+    """Precompute the shift plan of an FBlock. Identical factor matrices
+    (with identical W, D) share one cached plan.
+
+    :M: Factor-Matrix
+    :W: bit width of integers
+    :D: decimal bit positions
+    :returns: tuple with one entry per matrix line, each a tuple of shifts in form (column, positions, sign)
+
+    """
+    M = np.ascontiguousarray(M)
+    return _shift_plan(M.tobytes(), M.shape, M.dtype.str, W, D)
+
+
+@lru_cache(maxsize=1024)
+def _shift_plan(data, shape, dtype, W, D):
+    """Cached helper of _build_accs, the matrix is passed as raw bytes."""
+    M = np.frombuffer(data, dtype=dtype).reshape(shape)
+    per_row = [[] for _ in range(shape[0])]
+    for y, x, positions, positive in get_shifts(M, W, D).tolist():
+        per_row[y].append((x, positions, positive))
+    return tuple(tuple(line) for line in per_row)
+
+
+def gen_fblock(M, W, D, name_postfix="", shift_plan=None, verbose=False):
     """Generate an FBlock Module.
 
     :M: Factor-Matrix
     :W: bit width of integers
     :D: decimal bit positions
     :name_postfix: post fix for module names ("fblock"+postfix) (default: "")
+    :shift_plan: precomputed result of _build_accs(M, W, D) (default: computed here)
+    :verbose: True, if every shift should be printed to STDOUT (default: False)
     :returns: Module object
 
     """
@@ -42,40 +91,29 @@ def gen_fblock(M, W, D, name_postfix=""):
     v = [Integer(width=W, buffer=0, name=f"v{i}") for i in range(M.shape[1])]
     for s in v:
         s._accessed += 1
+    if shift_plan is None:
+        shift_plan = _build_accs(M, W, D)
     z = []
-    for y, line in enumerate(M): # Scan matrix lines
+    for y, line in enumerate(shift_plan): # Scan matrix lines
         accs = []
-        for x, e in enumerate(line): # For entries unequal to 0
-            if e != 0:
-                shifts = get_shifts(e, W, D) # Extract shifts, signs and positions
-                for positions, positive in shifts:
-                    print(y, x, positions)
-                    if positions < -D:
-                        positions = -D
-                    v_shifted = v[x].shift(positions=positions)
-                    accs.append((v_shifted, positive))
-        if len(accs) == 1:
-            z.append(accs[0][0])
-        if len(accs) == 2: # Generate Additions
-            if accs[0][1] and accs[1][1]:
-                z.append(accs[0][0].add(accs[1][0]))
-            elif accs[0][1] and not accs[1][1]:
-                z.append(accs[0][0].sub(accs[1][0]))
-            elif not accs[0][1] and accs[1][1]:
-                z.append(accs[1][0].sub(accs[0][0]))
-            else:
-                z.append(accs[0][0].add(accs[1][0]))
-        if len(accs) == 3: # Generate Additions
-            if accs[0][1] > 0:
-                z.append(accs[0][0].add3(accs[1][0], accs[2][0], accs[1][1], accs[2][1]))
-            elif accs[1][1] > 0:
-                z.append(accs[1][0].add3(accs[0][0], accs[2][0], accs[0][1], accs[2][1]))
-            else: 
-                z.append(accs[2][0].add3(accs[0][0], accs[1][0], accs[0][1], accs[1][1]))
+        for x, positions, positive in line: # Shifts, signs and positions of the entries
+            if verbose:
+                print(y, x, positions)
+            if positions < -D:
+                positions = -D
+            v_shifted = v[x].shift(positions=positions)
+            accs.append((v_shifted, positive))
+        if len(accs) > 0: # Generate Additions
+            pos_idx = next((k for k, (_, positive) in enumerate(accs) if positive), 0)
+            pivot, positive = accs[pos_idx]
+            if not positive: # only negative operands
+                pivot = pivot.complement()
+            rest = [acc for k, acc in enumerate(accs) if k != pos_idx]
+            z.append(pivot.addN([r[0] for r in rest], [r[1] for r in rest]))
     return mod
 
 
-def gen_p2d(Ms, W, D, slice_dims, dim, name="p2d"):
+def gen_p2d(Ms, W, D, slice_dims, dim, name="p2d", workers=1):
     """Generates a Module for a p2d decomposition (DMP).
 
     :Ms: matrices in the sliced decomposition (list of slices, each slice list of factors)
@@ -84,33 +122,58 @@ def gen_p2d(Ms, W, D, slice_dims, dim, name="p2d"):
     :slice_dims: list with slice widths (number of columns for each individual slice)
     :dim: dimension of the original matrix
     :name: name for the module (default: "p2d")
+    :workers: number of processes for the shift plans of the factors, None uses all CPUs.
+        Plans computed in worker processes do not fill the plan cache of _build_accs (default: 1, no multiprocessing)
     :returns: list of all created modules, first one is top module
 
     """
     mod = Module(name)
     # Create inputs
     v = [Integer(width=W, buffer=1) for _ in range(dim[1])]
-    zero = Integer.constant(0, W, D)
+    # shared zero constant for padded slices (an unused constant would become an output port)
+    pads = [mats[0].shape[1]-slice_dims[idx_slice] for idx_slice, mats in enumerate(Ms)]
+    zero = Integer.constant(0, W, D) if max(pads, default=0) > 0 else None
+    # shift plans of the factors are independent, modules are built serially afterwards
+    tasks = [mat for mats in Ms for mat in mats]
+    if workers == 1:
+        plans = [_build_accs(mat, W, D) for mat in tasks]
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as ex:
+            plans = list(ex.map(_build_accs, tasks, repeat(W), repeat(D)))
+    plans = iter(plans)
     v_used = 0
     zs = []
     fblocks = []
-    for idx_slice, mats in enumerate(Ms): # For each slice
-        # Create (intermediary) vector
-        vp = v[v_used:v_used+slice_dims[idx_slice]] + [zero for _ in range(mats[0].shape[1]-slice_dims[idx_slice])]
-        v_used += slice_dims[idx_slice]
-        for idx_factor, mat in enumerate(mats): # Generate factors
-            fblock = gen_fblock(mat, W, D, name_postfix=f"_{name}_{idx_slice}_{idx_factor}")
-            fblocks.append(fblock)
-            signals = {p[0]: vp[idx_port] for idx_port, p in enumerate(fblock.get_ports()[1])}
-            vp = mod.add_module(fblock, signals=signals)
-        zs.append(vp)
-    for idx in range(dim[0]): # Generate Addertree
-        sigs = [z[idx] for z in zs]
-        zt = Integer.acc(sigs, tia=False)
-        zt.set_buffer(1)
+    with gc_paused():
+        for idx_slice, mats in enumerate(Ms): # For each slice
+            # Create (intermediary) vector
+            vp = v[v_used:v_used+slice_dims[idx_slice]] + [zero] * pads[idx_slice]
+            v_used += slice_dims[idx_slice]
+            for idx_factor, mat in enumerate(mats): # Generate factors
+                fblock = gen_fblock(mat, W, D, name_postfix=f"_{name}_{idx_slice}_{idx_factor}", shift_plan=next(plans))
+                fblocks.append(fblock)
+                signals = {p[0]: vp[idx_port] for idx_port, p in enumerate(fblock.get_ports()[1])}
+                vp = mod.add_module(fblock, signals=signals)
+            zs.append(vp)
+        for idx in range(dim[0]): # Generate Addertree
+            sigs = [z[idx] for z in zs]
+            zt = Integer.acc(sigs, tia=False)
+            zt.set_buffer(1)
     return [mod] + fblocks
 
 
+def _render_dot(path):
+    """Start the compilation of a dot graph to pdf (path.dot -> path.pdf).
+    The dot process runs in the background, so the graph generation can
+    continue meanwhile.
+
+    :path: path of the graph files without extension
+    :returns: Popen object of the dot process
+
+    """
+    return subprocess.Popen(["dot", "-Tpdf", f"{path}.dot", "-o", f"{path}.pdf"])
+
+
 def gen_lzd(D, mats, W, stages=0, print_graph=None, verbose=False):
     """Generates a Module for a lzd decomposition.
     Verbose text output is possible. Generated graphs at different points
@@ -131,167 +194,165 @@ def gen_lzd(D, mats, W, stages=0, print_graph=None, verbose=False):
     pr1 = 2
     pr2 = 10
     edges = []
-    deps = []
     
     # extract shifts and node depencencies from matrix-factors
+    coeffs = np.zeros((len(mats), max([len(mat[0]) for mat in mats], default=0)))
     for p, mat in enumerate(mats):
-        row = []
-        for i, e in enumerate(mat[0]):
-            if e != 0:
-                shifts = to_csd(e, pr1, pr2)
-                for j, b in enumerate(shifts):
-                    if b != 0:
-                        row.append([p-i+D[0]-1, p+D[0], -1 if e < 0 else 1, pr1-j-1])
-        deps.append(row)
+        coeffs[p, :len(mat[0])] = mat[0]
+    if extract_shifts_from_mats is not None:
+        dep_table = extract_shifts_from_mats(coeffs, D[0], pr1, pr2)
+    else:
+        csd = to_csd_batch(coeffs.ravel(), pr1, pr2).reshape(*coeffs.shape, pr2)
+        ps, is_, js = np.nonzero(csd)
+        signs = np.where(coeffs[ps, is_] < 0, -1, 1)
+        dep_table = np.stack([ps-is_+D[0]-1, ps+D[0], signs, pr1-js-1], axis=1)
+    deps = [[] for _ in mats]
+    for row in dep_table.tolist():
+        deps[row[1]-D[0]].append(row)
 
     # print statement
     if verbose:
         for l in deps:
             print(l[0][1], l[0][0], l[1][0])
     
-    # create graph representation
-    if print_graph is not None:
-        outstr = []
-        for i in range(D[0])[::-1]:
-            outstr.append(f"x{i}")
-        outstr.append("{ rank=same " + " ".join([f"x{i}" for i in range(D[0])]) + " }")
-        for es in deps:
-            for a, b,_,_ in es:
-                outstr.append(f"x{a} -> x{b}")
-            outstr.append("{ rank=same " + f"x{es[0][1]}" + " }")
-        f = open(f"{print_graph}.dot", "w")
-        f.write("digraph D {\n")
-        f.write("\n".join(outstr))
-        f.write("\n}")
-        f.close()
-        os.system(f"dot -Tpdf {print_graph}.dot -o {print_graph}.pdf")
-    graph = [[i for i in range(D[0])[::-1]]]
-
-    # print statement
-    if verbose:
-        for i in graph:
-            print(i)
-        print()
-
-    # keep track of buffer nodes
-    buffers = {}
-    def add_buffer(buffer, i, j):
-        if i not in buffer:
-            buffer[i] = []
-        buffer[i].append(j)
-        return buffer
-
-    # function to find layer of a node in the graph
-    def find_in_graph(graph, i, buffers=None):
-        for li, l in enumerate(graph[::-1]):
-            if i in l:
-                return len(graph)-li-1
-            elif buffers is not None:
-                for x in buffers:
-                    if i in buffers[x]:
-                        return len(graph)-li-1
-
-
-    # find terminal nodes 
-    final_nodes = []
-    for x, line in enumerate(Pj):
-        for y, e in enumerate(line):
-            if e != 0:
-                final_nodes.append(len(mats)+D[0]-1-y)
+    renders = [] # background dot processes
+    try:
+        # create graph representation
+        if print_graph is not None:
+            buf = io.StringIO()
+            buf.write("digraph D {\n")
+            buf.write("\n".join([f"x{i}" for i in range(D[0])[::-1]]))
+            buf.write("\n{ rank=same " + " ".join([f"x{i}" for i in range(D[0])]) + " }")
+            for es in deps:
+                buf.write("".join([f"\nx{a} -> x{b}" for a, b,_,_ in es]))
+                buf.write(f"\n{{ rank=same x{es[0][1]} }}")
+            buf.write("\n}")
+            with open(f"{print_graph}.dot", "w") as f:
+                f.write(buf.getvalue())
+            renders.append(_render_dot(print_graph))
+        graph = [[i for i in range(D[0])[::-1]]]
+        # layer of each node in the graph
+        node_layer = {i: 0 for i in graph[0]}
+        def place(n, i):
+            graph[i].append(n)
+            node_layer[n] = i
+
+        # print statement
+        if verbose:
+            for i in graph:
+                print(i)
+            print()
+
+        # keep track of buffer nodes
+        buffers = {}
+        def add_buffer(buffer, i, j):
+            if i not in buffer:
+                buffer[i] = []
+            buffer[i].append(j)
+            return buffer
+
+
+        # find terminal nodes 
+        final_nodes = (len(mats)+D[0]-1-np.nonzero(Pj)[1]).tolist()
             
-    # insert all nodes into graph
-    for p, layer in enumerate(deps):
-        x = max([find_in_graph(graph, e[0], buffers) for e in layer])
-        while x+1 >= len(graph):
-            graph.append([])
-        graph[x+1].append(p+D[0])
-    edges = []
-    nn = len(mats)+D[0]
-
-    # insert new final nodes iff required (not in last layer)
-    for i in range(D[1]):
-        fn = final_nodes[i]
-        if not (fn in graph[-1]):
-            graph[-1].append(nn)
-            deps.append([[fn, nn]])
-            final_nodes[i] = nn
-            nn += 1
-
-    # create list of edges and insert buffers
-    for p, layer in enumerate(deps):
-        for e in layer:
-            a = find_in_graph(graph, e[0])
-            b = find_in_graph(graph, e[1])
-            na = e[0]
-            ne = e[1]
-            add_last_edge = True
-            for i in range(b-1, a, -1):
-                if na in buffers:
-                    bufs = [x for x in buffers[e[0]] if find_in_graph(graph, x) == i]
-                    if len(bufs) > 0:
-                        edges.append([bufs[0], ne])
-                        add_last_edge = False
-                        break
-                graph[i].append(nn)
-                edges.append([nn, ne])
-                ne = nn
-                buffers = add_buffer(buffers, na, nn)
+        # insert all nodes into graph
+        for p, layer in enumerate(deps):
+            x = max([node_layer[e[0]] for e in layer])
+            while x+1 >= len(graph):
+                graph.append([])
+            place(p+D[0], x+1)
+        edges = []
+        nn = len(mats)+D[0]
+
+        # insert new final nodes iff required (not in last layer)
+        for i in range(D[1]):
+            fn = final_nodes[i]
+            if node_layer[fn] != len(graph)-1:
+                place(nn, len(graph)-1)
+                deps.append([[fn, nn]])
+                final_nodes[i] = nn
                 nn += 1
-            if add_last_edge:
-                edges.append([na, ne])
+
+        # create list of edges and insert buffers
+        for p, layer in enumerate(deps):
+            for e in layer:
+                a = node_layer[e[0]]
+                b = node_layer[e[1]]
+                na = e[0]
+                ne = e[1]
+                add_last_edge = True
+                for i in range(b-1, a, -1):
+                    if na in buffers:
+                        bufs = [x for x in buffers[e[0]] if node_layer[x] == i]
+                        if len(bufs) > 0:
+                            edges.append([bufs[0], ne])
+                            add_last_edge = False
+                            break
+                    place(nn, i)
+                    edges.append([nn, ne])
+                    ne = nn
+                    buffers = add_buffer(buffers, na, nn)
+                    nn += 1
+                if add_last_edge:
+                    edges.append([na, ne])
     
-    # print statement
-    if verbose:
+        # predecessors of each node
+        preds = {}
         for e in edges:
-            print(e)
-
-    # create buffered graph representation
-    def buffer_node(x):
-        for y in buffers:
-            if x in buffers[y]:
-                return True
-        return False
-
-    if print_graph is not None:
-
-        # find critical path
-        critical_paths = [[i] for i in graph[-1]]
-        for i in range(len(graph)-1):
-            ncps = []
-            for cp in critical_paths:
-                es = [x for x in edges if x[1] == cp[-1]]
-                for n,_ in es:
-                    if not buffer_node(n):
-                        ncps.append(cp+[n])
-            critical_paths = ncps
-        critical_paths = {x for path in critical_paths for x in path}
-        print(critical_paths)
-
-        outstr = []
-        for height, layer in enumerate(graph):
-            for li, e in enumerate(layer):
-                if e < D[0]:
-                    outstr.append(f"x{e} [color=black, shape=invtriangle, width=0.8, style=filled, fillcolor=teal, fontcolor=white]")
-                elif e in final_nodes:
-                    outstr.append(f"x{e} [color=black, shape=invtriangle, width=0.8, style=filled, fillcolor=teal, fontcolor=white]")
-                elif buffer_node(e):
-                    outstr.append(f"x{e} [label=\"\", color=black, shape=point, width=0.15]")
-                elif e in critical_paths:
-                    outstr.append(f"x{e} [color=black, style=filled, fillcolor=purple, fontcolor=white]")
-                else:
-                    outstr.append(f"x{e} [style=filled, fillcolor=grey, fontcolor=black]")
-        for e in edges:
-            if buffer_node(e[1]):
-                outstr.append(f"x{e[0]} -> x{e[1]} [dir=none]")
-            else:
-                outstr.append(f"x{e[0]} -> x{e[1]}")
-        f = open(f"{print_graph}_buffer.dot", "w")
-        f.write("digraph D {\n")
-        f.write("\n".join(outstr))
-        f.write("\n}")
-        f.close()
-        os.system(f"dot -Tpdf {print_graph}_buffer.dot -o {print_graph}_buffer.pdf")
-        exit()
+            preds.setdefault(e[1], []).append(e)
+
+        # print statement
+        if verbose:
+            for e in edges:
+                print(e)
+
+        # create buffered graph representation
+        buffer_set = {n for l in buffers.values() for n in l}
+        buffer_node = buffer_set.__contains__
+
+        if print_graph is not None:
+
+            # find critical path
+            critical_paths = [[i] for i in graph[-1]]
+            for i in range(len(graph)-1):
+                ncps = []
+                for cp in critical_paths:
+                    es = preds.get(cp[-1], [])
+                    for n,_ in es:
+                        if not buffer_node(n):
+                            ncps.append(cp+[n])
+                critical_paths = ncps
+            critical_paths = {x for path in critical_paths for x in path}
+            print(critical_paths)
+
+            buf = io.StringIO()
+            buf.write("digraph D {\n")
+            for height, layer in enumerate(graph):
+                for li, e in enumerate(layer):
+                    if e < D[0]:
+                        buf.write(f"x{e} [color=black, shape=invtriangle, width=0.8, style=filled, fillcolor=teal, fontcolor=white]\n")
+                    elif e in final_nodes:
+                        buf.write(f"x{e} [color=black, shape=invtriangle, width=0.8, style=filled, fillcolor=teal, fontcolor=white]\n")
+                    elif buffer_node(e):
+                        buf.write(f"x{e} [label=\"\", color=black, shape=point, width=0.15]\n")
+                    elif e in critical_paths:
+                        buf.write(f"x{e} [color=black, style=filled, fillcolor=purple, fontcolor=white]\n")
+                    else:
+                        buf.write(f"x{e} [style=filled, fillcolor=grey, fontcolor=black]\n")
+            buf.write("\n".join([f"x{a} -> x{b}{' [dir=none]' if b in buffer_set else ''}" for a, b in edges]))
+            buf.write("\n}")
+            with open(f"{print_graph}_buffer.dot", "w") as f:
+                f.write(buf.getvalue())
+            renders.append(_render_dot(f"{print_graph}_buffer"))
+            for proc in renders:
+                if proc.wait() != 0:
+                    raise subprocess.CalledProcessError(proc.returncode, proc.args)
+            exit()
+    finally:
+        for proc in renders: # reap the dot processes that were not waited for (error)
+            if proc.poll() is None:
+                proc.kill()
+                proc.wait()
     
     # print statement
     if verbose:
@@ -309,25 +370,27 @@ def gen_lzd(D, mats, W, stages=0, print_graph=None, verbose=False):
             edge_in[n] = []
     for e in edges:
         edge_in[e[1]].append(e)
-    n = D[0]
-    stack = []
-    while n in edge_in:
-        stack.append(n)
-        n += 1
-    while len(stack) > 0:
-        n, stack = stack[0], stack[1:]
+    # topological order of the nodes (Kahn)
+    indeg = {n: len(edge_in[n]) for n in edge_in}
+    succ = defaultdict(list)
+    for e in edges:
+        succ[e[0]].append(e[1])
+    order = deque(n for n in edge_in if indeg[n] == 0)
+    topo = []
+    while len(order) > 0:
+        n = order.popleft()
+        topo.append(n)
+        for m in succ[n]:
+            indeg[m] -= 1
+            if indeg[m] == 0:
+                order.append(m)
+    for n in topo:
         if len(edge_in[n]) == 1: # assignment
             e0 = edge_in[n][0]
-            if e0[0] not in v:
-                stack.append(n)
-                continue
             v[e0[1]] =v[e0[0]].copy(f"x{n}", mod)
         elif len(edge_in[n]) == 2: # addition
             a = edge_in[n][0]
             b = edge_in[n][1]
-            if (a[0] not in v) or (b[0] not in v):
-                stack.append(n)
-                continue
             ax = v[a[0]].shift(a[3])
             bx = v[b[0]].shift(a[3])
             v[a[1]] = ax.add(bx)
@@ -0,0 +1,30 @@
+import numpy as np
+
+# the numba kernel is None if numba is not available, the numpy version is used then
+from csd_conv_nb import to_csd_batch_nb
+
+
+def to_csd_batch(ns, wd, w):
+    """Vectorized CSD conversion of several numbers at once.
+    The digits are determined one position at a time for all numbers
+    in parallel (greedy recoding on the residuals): a digit is set if the
+    residual exceeds 2/3 of its weight. Only the w digits with the weights
+    2**(wd-1) down to 2**(wd-w) are produced.
+
+    :ns: flat array of float numbers
+    :wd: number of integer bits
+    :w: total bit width
+    :returns: np.array of shape (len(ns), w) with the CSD digits (-1, 0, 1), most significant digit first
+
+    """
+    r = np.array(ns, dtype=np.float64).ravel()
+    if to_csd_batch_nb is not None:
+        return to_csd_batch_nb(r, wd, w)
+    csd = np.zeros((len(r), w))
+    for i in range(w):
+        k = wd-i-1
+        t = np.ldexp(2/3, k)
+        b = np.where(r > t, 1., np.where(r < -t, -1., 0.))
+        csd[:, i] = b
+        r -= np.ldexp(b, k)
+    return csd
@@ -0,0 +1,88 @@
+import math
+import numpy as np
+try:
+    from numba import njit
+except ImportError: # numba is not available, callers use the numpy versions
+    njit = None
+
+
+def to_csd_nb(n, wd, w):
+    """Numba version of the CSD conversion of a single number.
+
+    :n: input float number
+    :wd: number of integer bits
+    :w: total bit width
+    :returns: np.array of length w with the CSD digits (-1, 0, 1), most significant digit first
+
+    """
+    csd = np.empty(w)
+    r = n
+    for i in range(w):
+        k = wd-i-1
+        t = math.ldexp(2/3, k)
+        if r > t:
+            csd[i] = 1.
+            r -= math.ldexp(1., k)
+        elif r < -t:
+            csd[i] = -1.
+            r += math.ldexp(1., k)
+        else:
+            csd[i] = 0.
+    return csd
+
+
+def to_csd_batch_nb(ns, wd, w):
+    """Numba version of the CSD conversion of several numbers at once.
+
+    :ns: flat array of float numbers
+    :wd: number of integer bits
+    :w: total bit width
+    :returns: np.array of shape (len(ns), w) with the CSD digits (-1, 0, 1)
+
+    """
+    csd = np.empty((len(ns), w))
+    for i in range(len(ns)):
+        csd[i] = to_csd_nb(ns[i], wd, w)
+    return csd
+
+
+def extract_shifts_from_mats(coeffs, D0, pr1, pr2):
+    """Extract shifts and node dependencies from the matrix-factors of a lzd decomposition.
+
+    :coeffs: first rows of the matrix-factors, stacked (zero padded) into one array
+    :D0: number of input nodes
+    :pr1: number of integer bits for the CSD conversion
+    :pr2: total bit width for the CSD conversion
+    :returns: np.array with one row (source node, target node, sign, shift) per nonzero CSD digit
+
+    """
+    P, C = coeffs.shape
+    csd = np.zeros((P, C, pr2))
+    K = 0
+    for p in range(P):
+        for i in range(C):
+            if coeffs[p, i] != 0:
+                csd[p, i] = to_csd_nb(coeffs[p, i], pr1, pr2)
+                for j in range(pr2):
+                    if csd[p, i, j] != 0:
+                        K += 1
+    deps = np.empty((K, 4), dtype=np.int64)
+    k = 0
+    for p in range(P):
+        for i in range(C):
+            for j in range(pr2):
+                if csd[p, i, j] != 0:
+                    deps[k, 0] = p-i+D0-1
+                    deps[k, 1] = p+D0
+                    deps[k, 2] = -1 if coeffs[p, i] < 0 else 1
+                    deps[k, 3] = pr1-j-1
+                    k += 1
+    return deps
+
+
+if njit is None:
+    to_csd_nb = to_csd_batch_nb = extract_shifts_from_mats = None
+else: # compile in order of use, to_csd_nb is called by the other kernels
+    to_csd_nb = njit("f8[:](f8, i8, i8)", cache=True)(to_csd_nb)
+    to_csd_batch_nb = njit("f8[:,:](f8[:], i8, i8)", cache=True)(to_csd_batch_nb)
+    extract_shifts_from_mats = njit("i8[:,:](f8[:,:], i8, i8, i8)", cache=True)(extract_shifts_from_mats)
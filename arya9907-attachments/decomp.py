@@ -1,4 +1,5 @@
 import numpy as np
+from collections import deque
 
 from computationcoding.decomp_pwr2 import power2decomp as dp2d
 from computationcoding.lzdecomp import fastlzdecomp as dlzd
@@ -15,7 +16,8 @@ def slice_mat(M, S):
     :returns: list of matrix slices
 
     """
-    mats = [M[:, sum(S[:i-1]):sum(S[:i])] for i in range(1, len(S)+1)]
+    offsets = np.concatenate(([0], np.cumsum(S)))
+    mats = [M[:, offsets[i]:offsets[i+1]] for i in range(len(S))]
     return mats
 
 
@@ -32,8 +34,16 @@ def decomp_p2d(D, M, mats, E, S, sqnr_target=48, verbose=False):
     :returns: list of decompositions (one entry for each slice), final accuracy in dB, total number of additions, number of factors
 
     """
-    factors = [[np.eye(*mats[s].shape)] for s in range(len(S))]
-    approxes = [np.eye(*mats[s].shape) for s in range(len(S))]
+    # integer matrices are approximated in floating point (the factors are not integer)
+    dtypes = [np.result_type(mats[s].dtype, np.float64) for s in range(len(S))]
+    factors = [[np.eye(*mats[s].shape, dtype=dtypes[s])] for s in range(len(S))]
+    # approximations of the slices are views into one buffer of the whole matrix
+    offsets = np.concatenate(([0], np.cumsum(S)))
+    concat_buffer = np.concatenate([np.eye(*mats[s].shape, dtype=dtypes[s]) for s in range(len(S))], axis=1)
+    approxes = [concat_buffer[:, offsets[s]:offsets[s+1]] for s in range(len(S))]
+    # single precision is sufficient for the convergence check
+    M32 = M.astype(np.float32)
+    buf32 = np.empty(concat_buffer.shape, dtype=np.float32)
     snr = 0
     p = 0
     adds = 0
@@ -41,12 +51,15 @@ def decomp_p2d(D, M, mats, E, S, sqnr_target=48, verbose=False):
         p += 1
         for s in range(len(S)):
             W = dp2d(mats[s].T, approxes[s].T, E).T
-            approxes[s] = W @ approxes[s]
+            np.matmul(W, approxes[s], out=approxes[s])
             factors[s].append(W)
             if verbose:
                 print(p, s, SNRmat(mats[s], approxes[s]))
             adds += get_adds(W)
-        snr = SNRmat(M, np.concatenate(approxes, axis=1))
+        np.copyto(buf32, concat_buffer)
+        snr = SNRmat(M32, buf32)
+        if snr >= sqnr_target: # confirm in double precision, the returned snr meets the target
+            snr = SNRmat(M, concat_buffer)
         if verbose:
             print(p, snr, adds)
         if p > 200:
@@ -81,17 +94,17 @@ def generate_all_slicings(tot, y):
     """
     slicings_done = []
     factors = list(range(1,y+1))
-    ss = [[x] for x in factors]
+    ss = deque(([x], x) for x in factors) # partial slicings with their total width
     while len(ss) > 0:
-        s, ss = ss[0], ss[1:]
+        s, width = ss.popleft()
         for f in factors:
-            if sum(s) + f > tot:
+            if width + f > tot:
                 continue
             x = s + [f]
-            if sum(x) == tot:
+            if width + f == tot:
                 slicings_done.append(x)
             else:
-                ss.append(x)
+                ss.append((x, width + f))
     return slicings_done
 
 
@@ -110,6 +123,7 @@ def test(y=4, E=2, mode="p2d lzd", lzd_maxadd=np.infty):
     """
     D = (y,y)
     M = np.random.rand(*D)*2-1
+    M.setflags(write=False) # shared by all slicings, slices are read-only views
     print("Target matrix:")
     print(M)
     print()
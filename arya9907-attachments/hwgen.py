@@ -1,12 +1,40 @@
 import numpy as np
+import ast
+import gc
+from array import array
 import os
-import pdb
+import re
+import sys
+from collections import deque
+from contextlib import contextmanager
+from functools import lru_cache
 
 from decomp import decomp_lzd, decomp_p2d
 
 
+@contextmanager
+def gc_paused():
+    """Pauses the cyclic garbage collector while a signal graph is built.
+    Signals and blocks live as long as their module, so collection passes
+    during construction only rescan them.
+    Nested use is possible, the collector is only re-enabled by the
+    outermost context.
+
+    :returns: context manager
+
+    """
+    enabled = gc.isenabled()
+    gc.disable()
+    try:
+        yield
+    finally:
+        if enabled:
+            gc.enable()
+
+
 class Sort:
     """Class Sort. This is the top class for all Signal types. Direct use is not recommended."""
+    __slots__ = ('_name', '_module', '_buffer', '_buffer_access', '_accessed', '_assigned', '_dummy', '_internal_port')
     _ID = 0
     def __init__(self, name=None, module=None, dummy=False, buffer=None):
         """Initializes attributes of the signal
@@ -18,18 +46,19 @@ class Sort:
 
         """
         if not name:
-            self._name = f"sig{Sort._ID}"
+            self._name = sys.intern(f"sig{Sort._ID}")
             Sort._ID += 1
         else:
-            self._name = name
+            self._name = sys.intern(name)
         if not module:
-            if len(Module.MODULE_STACK) == 0:
+            stack = Module.MODULE_STACK
+            if not stack:
                 raise Exception("There are no open modules")
-            module = Module.MODULE_STACK[-1]
+            module = stack[-1]
         self._module = module
         if not dummy:
             self._module.add_value(self)
-        self._buffer = 0 if not buffer else buffer
+        self.set_buffer(0 if not buffer else buffer)
         self._accessed = 0
         self._assigned = 0
         self._dummy = dummy
@@ -40,45 +69,25 @@ class Sort:
     def copy(self, name, module):
         """Returns a new copy of the signal"""
         return Sort(name=name, module=module)
-    def _access(self, mode="VHDL", **args):
-        """Creates a access for the signal. Behavior depends on the mode.
-
-        mode = "VHDL":
-            Returns an access string to the signal.
-            If the Signal is buffered, the last buffer is returned.
+    def _access(self):
+        """Creates a VHDL access string for the signal.
+        If the Signal is buffered, the last buffer is returned.
 
-        :mode: mode of the signal access. See above
         :returns: Returns an access to the signal
 
         """
         if self._buffer > 0:
-            if "buffer" in args:
-                buffer = args["buffer"]
-                if buffer < 0 or buffer > self._buffer:
-                    buffer = self._buffer
-            else:
-                buffer = self._buffer
-            return f"b{buffer}_{self._name}"
+            return self._buffer_access[-1]
         return self._name
-    def _assign(self, mode="VHDL", **args):
-        """Creates a assignment for the signal. Behavior depends on the mode.
+    def _assign(self):
+        """Creates a VHDL assignment string for the signal.
+        Assignment is always to buffer 0.
 
-        mode = "VHDL":
-            Returns an assignment string to the signal.
-            Assignment is always to buffer 0.
-
-        :mode: mode of the signal assignment. See above
         :returns: Returns an assignment to the signal
 
         """
         if self._buffer > 0:
-            if "buffer" in args:
-                buffer = args["buffer"]
-                if buffer < 0 or buffer > self._buffer:
-                    buffer = self._buffer
-            else:
-                buffer = 0
-            return f"b{buffer}_{self._name}"
+            return self._buffer_access[0]
         return self._name
     def assign(self, other):
         """Create an assignment of the other signal to this signal.
@@ -102,8 +111,12 @@ class Sort:
 
         """
         self._buffer = stages
+        self._buffer_access = [sys.intern(f"b{i}_{self._name}") for i in range(stages+1)] if stages > 0 else []
+        self._module._ports_dirty = True
 class Integer(Sort):
     """Signal type for Integers of a given bitwidth."""
+    __slots__ = ('_width', '_wd_sigs', '_wd_offs', '_gens', '_determined')
+    _LINKS = 0 # number of created width dependencies, see Module.determine_all_widths
     def __init__(self, width=None, **args):
         """Initializes attributes of the integer
 
@@ -112,8 +125,11 @@ class Integer(Sort):
         """
         super().__init__(**args)
         self._width = width
-        self._width_deps = []
-        self._gens = []
+        # width dependencies: self._width == self._wd_sigs[i]._width + self._wd_offs[i]
+        # dependencies and generators are allocated on first use (see _link, _add_gen)
+        self._wd_sigs = None
+        self._wd_offs = None
+        self._gens = None
         if self._width != None:
             self._determined = True
     def copy(self, name, module, new_width=None, assign_sig=False, mode="VHDL"):
@@ -130,33 +146,72 @@ class Integer(Sort):
             x = Integer(name=name, module=module, width=new_width)
         else:
             x = Integer(name=name, module=module, width=self._width)
-        x._width_deps.append((self,0))
-        self._width_deps.append((x,0))
+        x._link(self)
         self._accessed += 1
+        self._module._ports_dirty = True # port properties of this integer may change
         x._assigned += 1
         if assign_sig:
             if mode=="VHDL":
-                x._gens.append((lambda a, b: f"{a._assign()} <= {b._access(upper=x._width-1)};", (x, self)))
+                x._add_gen(Integer._emit_copy, (x, self))
         return x
+    def _link(self, other, off=0):
+        """Adds a width dependency in both directions: self._width == other._width + off.
+        Used internally only.
+
+        :other: other Integer object
+        :off: width offset of this integer relative to the other integer (default: 0)
+        :returns: None
+
+        """
+        if self._wd_sigs is None:
+            self._wd_sigs, self._wd_offs = [], array('i')
+        if other._wd_sigs is None:
+            other._wd_sigs, other._wd_offs = [], array('i')
+        self._wd_sigs.append(other)
+        self._wd_offs.append(off)
+        other._wd_sigs.append(self)
+        other._wd_offs.append(-off)
+        Integer._LINKS += 1 # invalidates the dependency graphs of the modules
+    def _add_gen(self, f, args):
+        """Adds a generator record (emitter function, arguments) to this signal.
+        Used internally only.
+
+        :f: emitter function, called as f(*args) in Integer.generate
+        :args: tuple of arguments for the emitter
+        :returns: None
+
+        """
+        if self._gens is None:
+            self._gens = [(f, args)]
+        else:
+            self._gens.append((f, args))
     def generate(self):
         """Generator function for this signal. Used internally only."""
-        return "\n".join([g[0](*g[1]) for g in self._gens])
+        gens = self._gens
+        if not gens:
+            return ""
+        if len(gens) == 1: # common case: a single assignment
+            f, a = gens[0]
+            return f(*a)
+        return "\n".join(f(*a) for f, a in gens)
+    @staticmethod
+    def _emit_copy(dst, src):
+        """Generator for the assignment of a copied integer. Used internally only."""
+        return f"{dst._assign()} <= {src._access(upper=dst._width-1)};"
+    @staticmethod
+    def _emit_const(dst, bits):
+        """Generator for the assignment of a constant integer. Used internally only."""
+        return f"{dst._assign()} <= \"{bits}\";"
     def determine(self, **args):
-        """Derermines the width of the integer if possible. Used interanlly only."""
-        others = args["others"] if "others" in args else {}
-        others[self] = self._width
-        for v, o in self._width_deps:
-            if not (v in others):
-                others = v.determine(others=others)
-            if not others[self]:
-                others[self] = others[v]+o if others[v] else None
-            if others[v]:
-                n = others[v] + o
-                if not n == others[self]:
-                    raise Exception(f"Integer width cannot be determined: {self._name}")
-                others[self] = n
-        self._width = others[self]
-        return others
+        """Derermines the width of the integer if possible. Used interanlly only.
+        The widths are resolved for the whole module at once (see Module.determine_all_widths).
+
+        :returns: width of the integer (None if it cannot be determined)
+
+        """
+        if not self._width:
+            self._module.determine_all_widths()
+        return self._width
     def init(self, mode='VHDL'):
         """Init the initalisation strings for this signal and its buffers.
         Supported modes:
@@ -170,18 +225,12 @@ class Integer(Sort):
             if self._buffer == 0:
                 return [(self._name, f"std_logic_vector({self._width-1} downto 0)")]
             else:
-                inits = []
-                for i in range(self._buffer+1):
-                    inits.append((f"b{i}_{self._name}", f"std_logic_vector({self._width-1} downto 0)"))
-                return inits
-    def _access(self, upper=None, lower=None, keep_vector=False, **args):
-        """Creates a access for the signal. Behavior depends on the mode.
-
-        mode = "VHDL":
-            Returns an access string to the signal.
-            If the Signal is buffered, the last buffer is returned.
-
-        :mode: mode of the signal access. See above
+                t = f"std_logic_vector({self._width-1} downto 0)"
+                return [(n, t) for n in self._buffer_access]
+    def _access(self, upper=None, lower=None, keep_vector=False):
+        """Creates a VHDL access string for the signal.
+        If the Signal is buffered, the last buffer is returned.
+
         :upper: upper end of the vector access
         :lower: lower end of the vector access
         :keep_vector: True if the vector type should be maintained (Default: cast to lower type)
@@ -190,49 +239,38 @@ class Integer(Sort):
         """
         if not self._width:
             raise Exception("Width has not been determined yet")
-        if not upper!=None and not lower!=None:
-            return super()._access(**args)
+        if upper is None and lower is None:
+            return super()._access()
         if not upper!=None:
             upper = self._width-1
         if not lower!=None:
             lower = 0
-        if upper >= self._width:
-            raise Exception("Range is not valid")
-        if lower < 0:
+        if __debug__ and (upper >= self._width or lower < 0):
             raise Exception("Range is not valid")
         if upper-lower == 0 and not keep_vector:
-            return super()._access(**args) + f"({lower})"
-        return super()._access(**args) + f"({upper} downto {lower})"
-    def _assign(self, upper=None, lower=None, **args):
-        """Create an assignment of the other signal to this signal.
-        Uses the AssignBlock class.
+            return super()._access() + f"({lower})"
+        return super()._access() + f"({upper} downto {lower})"
+    def _assign(self, upper=None, lower=None):
+        """Creates a VHDL assignment string for the signal.
+        Assignment is always to buffer 0.
 
-        mode = "VHDL":
-            Returns an access string to the signal.
-            If the Signal is buffered, the last buffer is returned.
-
-        :mode: mode of the signal access. See above
-        :other: Other signal which should be assigned
         :upper: upper end of the vector access
         :lower: lower end of the vector access
-        :returns: None
+        :returns: Returns an assignment to the signal
 
         """
         if not self._width:
             raise Exception("Width has not been determined yet")
-        if not upper!=None and not lower!=None:
-            return super()._assign(**args)
+        if upper is None and lower is None:
+            return super()._assign()
         if not upper!=None:
             upper = self._width-1
         if not lower!=None:
             lower = 0
-        if upper >= self._width:
-            pdb.set_trace()
-            raise Exception("Range is not valid")
-        if lower < 0:
+        if __debug__ and (upper >= self._width or lower < 0):
             raise Exception("Range is not valid")
-        return super()._assign(**args) + f"({upper} downto {lower})"
-    def add(self, other, long_name=False, name=None):
+        return super()._assign() + f"({upper} downto {lower})"
+    def add(self, other, long_name=False, name=None, pending=None):
         """Generate an addition with another Ingteger. This operation is based on the Add2Block.
         A new signal for the result will be generated and the corresponding width restrictions set accordingly.
 
@@ -241,6 +279,7 @@ class Integer(Sort):
         :other: other Integer object (second operand).
         :long_name: True if the name of the resulting signal should be descriptive (default: standard sigX naming)
         :name: name of the resulting signal (default: generated name)
+        :pending: list which collects the created block for a later Module.batch_add_blocks (default: block is added directly)
         :returns: result integer
 
         """
@@ -250,14 +289,15 @@ class Integer(Sort):
             r = Integer(module=self._module, name=name, width=self._width)
         else:
             r = Integer(module=self._module, width=self._width)
-        r._width_deps.append((self, 0))
-        r._width_deps.append((other, 0))
-        self._width_deps.append((r, 0))
-        other._width_deps.append((r, 0))
+        r._link(self)
+        r._link(other)
         r._assigned += 1
         self._accessed += 1
         other._accessed += 1
-        Add2Block(r, self, other, module=self._module)
+        if pending is None:
+            Add2Block(r, self, other, module=self._module)
+        else:
+            pending.append(Add2Block(r, self, other, module=self._module, defer_registration=True))
         return r
     def complement(self, long_name=False, name=None):
         """Generate the complement of the integer (- this). This operation is baed on the ComplementBlock.
@@ -276,8 +316,7 @@ class Integer(Sort):
             r = Integer(module=self._module, name=name, width=self._width)
         else:
             r = Integer(module=self._module, width=self._width)
-        r._width_deps.append((self, 0))
-        self._width_deps.append((r, 0))
+        r._link(self)
         r._assigned += 1
         self._accessed += 1
         ComplementBlock(r, self)
@@ -297,10 +336,8 @@ class Integer(Sort):
             r = Integer(name=f"{self._name}_minus_{other._name}", module=self._module, width=self._width)
         else:
             r = Integer(module=self._module, width=self._width)
-        r._width_deps.append((self, 0))
-        r._width_deps.append((other, 0))
-        self._width_deps.append((r, 0))
-        other._width_deps.append((r, 0))
+        r._link(self)
+        r._link(other)
         r._assigned += 1
         self._accessed += 1
         other._accessed += 1
@@ -322,16 +359,14 @@ class Integer(Sort):
             r = Integer(name=f"{self._name}_mult_{other._name}", module=self._module, width=self._width*2)
         else:
             r = Integer(module=self._module, width=self._width*2)
-        r._width_deps.append((self, self._width))
-        r._width_deps.append((other, self._width))
-        self._width_deps.append((r, self._width))
-        other._width_deps.append((r, self._width))
+        r._link(self, self._width)
+        r._link(other, self._width)
         r._assigned += 1
         self._accessed += 1
         other._accessed += 1
         Mult2Block(r, self, other, module=self._module)
         return r
-    def add3(self, other1, other2, sign1=1, sign2=1, long_name=False):
+    def add3(self, other1, other2, sign1=1, sign2=1, long_name=False, name=None):
         """Generate an addition with two other Ingtegers. Functionality
         is based on the custom add8_3.vhd block. Currently, only VHDL mode
         is supported.
@@ -345,11 +380,14 @@ class Integer(Sort):
         :sign1: sign of other1 operand (1 oder -1) (default: 1)
         :sign2: sign of other2 operand (1 oder -1) (default: 1)
         :long_name: True if the name of the resulting signal should be descriptive (default: standard sigX naming)
+        :name: name of the resulting signal (default: generated name)
         :returns: result integer
 
         """
         if long_name:
             r = Integer(name=f"{self._name}_plus_{other1._name}_plus_{other2._name}", module=self._module, width=self._width)
+        elif name != None:
+            r = Integer(module=self._module, name=name, width=self._width)
         else:
             r = Integer(module=self._module, width=self._width)
         if sign1 == 1 and sign2 == -1:
@@ -366,16 +404,40 @@ class Integer(Sort):
         other1._accessed += 1
         other2._accessed += 1
         r._assigned += 1
-        self._width_deps.append((r, 0))
-        other1._width_deps.append((r, 0))
-        other2._width_deps.append((r, 0))
-        r._width_deps.append((self, 0))
-        r._width_deps.append((other1, 0))
-        r._width_deps.append((other2, 0))
+        r._link(self)
+        r._link(other1)
+        r._link(other2)
+        return r
+    def addN(self, others, signs, long_name=False):
+        """Generate an addition with any number of other Integers. The operands
+        are reduced with Integer.add3 (two operands per step) and, for an odd
+        number of operands, a final Integer.add or Integer.sub.
+        New signals for the result and all intermediary steps will be
+        generated and the corresponding width restrictions set accordingly.
+
+        result = self + signs[0]*others[0] + signs[1]*others[1] + ...
+
+        :others: list of other Integer objects
+        :signs: list of signs of the other operands (True/1 positive, False/-1 negative)
+        :long_name: True if the name of the resulting signals should be descriptive (default: standard sigX naming)
+        :returns: result integer (self, if there are no other operands)
+
+        """
+        signs = [1 if s > 0 else -1 for s in signs]
+        r = self
+        for i in range(0, len(others)-1, 2):
+            r = r.add3(others[i], others[i+1], signs[i], signs[i+1], long_name=long_name)
+        if len(others) % 2 == 1:
+            if signs[-1] > 0:
+                r = r.add(others[-1], long_name=long_name)
+            else:
+                r = r.sub(others[-1], long_name=long_name)
         return r
     def acc(sigs, tia=True, name=None):
         """Generates an adder tree for accumulation of several signals.
         This accumulation is based on Integer.add2 and Integer.add3
+        The tree is built level by level: the operands are consumed in order
+        and every partial sum is queued behind the remaining operands.
         New signals for the result and all intermediary steps will be
         generated and the corresponding width restrictions set accordingly.
 
@@ -389,18 +451,23 @@ class Integer(Sort):
         """
         if len(sigs) == 0:
             raise Exception("Undefined empty accumulation")
-        if len(sigs) == 1:
-            return sigs[0]
-        if len(sigs) == 2:
-            return sigs[0].add(sigs[1])
-        if len(sigs) == 3 and tia:
-            return sigs[0].add3(sigs[1], sigs[2])
-        else:
-            left, right = sigs[:len(sigs)//2], sigs[len(sigs)//2:]
-            r1 = Integer.acc(left, tia=tia)
-            r2 = Integer.acc(right, tia=tia)
-            r = Integer.add(r1,r2, name=name)
-            return r
+        q = deque(sigs)
+        pending = [] # adder blocks, registered at their modules at once
+        with gc_paused():
+            while len(q) > 1:
+                last = len(q) == 2 or (tia and len(q) == 3) # the last operation gets the name
+                if tia and len(q) >= 3:
+                    a, b, c = q.popleft(), q.popleft(), q.popleft()
+                    q.append(a.add3(b, c, name=name if last else None))
+                else:
+                    a, b = q.popleft(), q.popleft()
+                    q.append(a.add(b, name=name if last else None, pending=pending))
+        by_module = {} # operands can come from different modules
+        for blk in pending:
+            by_module.setdefault(blk._module, []).append(blk)
+        for mod, blocks in by_module.items():
+            mod.batch_add_blocks(blocks)
+        return q[0]
     def shift(self, positions, arith=True, long_name=False):
         """Generates a shift of this integer. This function uses the
         ShiftBlock.
@@ -421,8 +488,7 @@ class Integer(Sort):
             r = Integer(module=self._module, width=self._width)
         r._assigned += 1
         self._accessed += 1
-        r._width_deps.append((self, 0))
-        self._width_deps.append((r, 0))
+        r._link(self)
 
         if positions == 0:
             AssignBlock(r, self, module=self._module, force_name=f"shift 0")
@@ -430,6 +496,7 @@ class Integer(Sort):
             AssignBlock(r, Integer.constant(0, self._width, decimals=0, module=self._module), force_name=f"shift {positions}")
         else:
             ShiftBlock(r, self, positions, arith=arith)
+        return r
     def constant(n, width, decimals, **args):
         """Returns an integer object, which is assigned the given contant value.
         If this function is called multiple times with the same arguments, the
@@ -441,17 +508,19 @@ class Integer(Sort):
         :returns: constant integer object
 
         """
+        cached = set(args) <= {"module"} # only plain constants are shared
+        if cached:
+            stack = Module.MODULE_STACK
+            module = args["module"] if args.get("module") else stack[-1] if stack else None
+            key = (n, width, decimals)
+            if module is not None and key in module._const_cache:
+                return module._const_cache[key]
         x = Integer(width=width, **args)
-        n *= 2**decimals
-        neg = n<0
-        n = ("{0:0"+str(width) +"b}").format(int(abs(n)))
-        if neg:
-            n0 = n[:n.rfind("1")]
-            n1 = n[n.rfind("1"):]
-            n0 = "".join(["0" if x == "1" else "1" for x in n0])
-            n = n0+n1
+        n = format(int(n*2**decimals) & ((1 << width) - 1), f"0{width}b") # two's complement
         x._assigned += 1
-        x._gens.append((lambda a: f"{a._assign()} <= \"{n}\";", (x,)))
+        x._add_gen(Integer._emit_const, (x, n))
+        if cached:
+            x._module._const_cache[key] = x
         return x
     def extend(self, width, arith=True, long_name=False):
         """Extends the bit-width of the integer. A new integer with the
@@ -510,18 +579,21 @@ class Block:
     """This is the super class for Blocks.
     Blocks represent the interconnection (pure or operational) between signals.
     """
-    def __init__(self, name, inputs, outputs, module=None, **args):
+    __slots__ = ('_inputs', '_outputs', '_name', '_module')
+    def __init__(self, name, inputs, outputs, module=None, defer_registration=False, **args):
         self._inputs = inputs
         self._outputs = outputs
         self._name = name
         if "force_name" in args:
             self._name = args["force_name"]
         if not module:
-            if len(Module.MODULE_STACK) == 0:
+            stack = Module.MODULE_STACK
+            if not stack:
                 raise Exception("There are no open modules")
-            module = Module.MODULE_STACK[-1]
+            module = stack[-1]
         self._module = module
-        self._module.add_block(self)
+        if not defer_registration: # otherwise registered later with Module.batch_add_blocks
+            self._module.add_block(self)
     def generateVHDL(self):
         """Generate VHDL for this block.
 
@@ -531,74 +603,84 @@ class Block:
         raise Exception("Not Implemented")
 class BinaryOpBlock(Block):
     """Super class for binary infix operations"""
+    __slots__ = ('_operator',)
+    _TEMPLATE = "{out} <= {in0} {op} {in1};"
     def __init__(self, name, result, operator, op1, op2, **args):
         super().__init__(name, [op1, op2], [result], **args)
         self._operator = operator
     def generateVHDL(self):
-        return f"{self._outputs[0]._assign(mode='VHDL')} <= {self._inputs[0]._access(mode='VHDL')} {self._operator} {self._inputs[1]._access(mode='VHDL')};"
-class BinarySignedOpBlock(Block):
+        a, b = self._inputs
+        return self._TEMPLATE.format(out=self._outputs[0]._assign(), in0=a._access(), in1=b._access(), op=self._operator)
+class BinarySignedOpBlock(BinaryOpBlock):
     """Super class for binary infix operations with a cast to signed"""
-    def __init__(self, name, result, operator, op1, op2, **args):
-        super().__init__(name, [op1, op2], [result], **args)
-        self._operator = operator
-    def generateVHDL(self):
-        return f"{self._outputs[0]._assign(mode='VHDL')} <= std_logic_vector(signed({self._inputs[0]._access(mode='VHDL')}) {self._operator} signed({self._inputs[1]._access(mode='VHDL')}));"
+    __slots__ = ()
+    _TEMPLATE = "{out} <= std_logic_vector(signed({in0}) {op} signed({in1}));"
 class UnaryOpBlock(Block):
     """Super class for unary prefix operations"""
+    __slots__ = ('_operator',)
+    _TEMPLATE = "{out} <= {op} {in0};"
     def __init__(self, name, result, operator, op, **args):
         super().__init__(name, [op], [result], **args)
         self._operator = operator
     def generateVHDL(self):
-        return f"{self._outputs[0]._assign(mode='VHDL')} <= {self._operator} {self._inputs[0]._access(mode='VHDL')};"
-class UnarySignedOpBlock(Block):
+        return self._TEMPLATE.format(out=self._outputs[0]._assign(), in0=self._inputs[0]._access(), op=self._operator)
+class UnarySignedOpBlock(UnaryOpBlock):
     """Super class for unary prefix operations with a cast to signed"""
-    def __init__(self, name, result, operator, op, **args):
-        super().__init__(name, [op], [result], **args)
-        self._operator = operator
-    def generateVHDL(self):
-        return f"{self._outputs[0]._assign(mode='VHDL')} <= std_logic_vector({self._operator} signed({self._inputs[0]._access(mode='VHDL')}));"
+    __slots__ = ()
+    _TEMPLATE = "{out} <= std_logic_vector({op} signed({in0}));"
 class Add2Block(BinarySignedOpBlock):
     """Block for binary addition"""
+    __slots__ = ()
     def __init__(self, result, op1, op2, **args):
         super().__init__("add2", result, '+', op1, op2, **args)
 class Sub2Block(BinarySignedOpBlock):
     """Block for binary subtraction"""
+    __slots__ = ()
     def __init__(self, result, op1, op2, **args):
         super().__init__("sub2", result, '-', op1, op2, **args)
 class Mult2Block(BinarySignedOpBlock):
     """Block for binary multiplication"""
+    __slots__ = ()
     def __init__(self, result, op1, op2, **args):
         super().__init__("mult2", result, '*', op1, op2, **args)
 class And2Block(BinaryOpBlock):
     """Block for binary logical and"""
+    __slots__ = ()
     def __init__(self, result, op1, op2, **args):
         super().__init__("and2", result, 'and', op1, op2, **args)
 class Or2Block(BinaryOpBlock):
     """Block for binary logical or"""
+    __slots__ = ()
     def __init__(self, result, op1, op2, **args):
         super().__init__("or2", result, 'or', op1, op2, **args)
 class Xor2Block(BinaryOpBlock):
     """Block for binary logical xor"""
+    __slots__ = ()
     def __init__(self, result, op1, op2, **args):
         super().__init__("xor2", result, 'xor', op1, op2, **args)
 class Nand2Block(BinaryOpBlock):
     """Block for binary logical nand"""
+    __slots__ = ()
     def __init__(self, result, op1, op2, **args):
         super().__init__("nand2", result, 'nand', op1, op2, **args)
 class Nor2Block(BinaryOpBlock):
     """Block for binary logical nor"""
+    __slots__ = ()
     def __init__(self, result, op1, op2, **args):
         super().__init__("nor2", result, 'nor', op1, op2, **args)
 class NotBlock(UnaryOpBlock):
     """Block for unary logical not"""
+    __slots__ = ()
     def __init__(self, result, op, **args):
         super().__init__("not", result, 'not', op, **args)
 class ComplementBlock(UnarySignedOpBlock):
     """Block for unary copmlement"""
+    __slots__ = ()
     def __init__(self, result, op, **args):
         super().__init__("comp", result, '-', op, **args)
 class ShiftBlock(Block):
     """Block for shift operation"""
+    __slots__ = ('_positions', '_arith')
     def __init__(self, result, sig, positions, arith=True, **args):
         super().__init__(f"shift {positions}", [sig], [result], **args)
         self._positions = positions
@@ -606,40 +688,39 @@ class ShiftBlock(Block):
     def generateVHDL(self):
         sig = self._inputs[0]
         r = self._outputs[0]
-        positions = self._positions
-        if positions > 0:
-            s = f"{r._assign(lower=positions)} <= {sig._access(upper=sig._width-positions-1, keep_vector=True)};\n"
-            s += f"{r._assign(upper=positions-1)} <= (others => '0');"
-            return s
-        elif positions < 0:
-            s = f"{r._assign(upper=r._width+positions-1)} <= {sig._access(lower=-positions, keep_vector=True)};\n"
-            if self._arith:
-                s += f"{r._assign(lower=r._width+positions)} <= (others => {sig._access(lower=sig._width-1)});"
-            else:
-                s += f"{r._assign(lower=r._width+positions)} <= (others => '0');"
-            return s
+        p = self._positions
+        w = sig._width
+        if p > 0:
+            return (f"{r._assign(lower=p)} <= {sig._access(upper=w-p-1, keep_vector=True)};\n"
+                    f"{r._assign(upper=p-1)} <= (others => '0');")
+        elif p < 0:
+            top = r._width+p # first bit filled by the shift
+            fill = sig._access(lower=w-1) if self._arith else "'0'"
+            return (f"{r._assign(upper=top-1)} <= {sig._access(lower=-p, keep_vector=True)};\n"
+                    f"{r._assign(lower=top)} <= (others => {fill});")
 class AssignBlock(Block):
     """Block for signal assignment"""
+    __slots__ = ()
     def __init__(self, result, sig, **args):
         super().__init__("assign", [sig], [result], **args)
     def generateVHDL(self):
         return f"{self._outputs[0]._assign()} <= {self._inputs[0]._access()};"
 class ExtendBlock(Block):
     """Block for signal width extention"""
+    __slots__ = ('_arith',)
     def __init__(self, result, sig, arith, **args):
         super().__init__(f"extend {result._width}", [sig], [result], **args)
         self._arith = arith
     def generateVHDL(self):
         b = self._outputs[0]
         a = self._inputs[0]
-        s = f"{b._assign(upper=a._width-1)} <= {a._access()};\n"
-        if self._arith:
-            s += f"{b._assign(lower=a._width)} <= (others => {a._access(upper=a._width-1, lower=a._width-1)});"
-        else:
-            s += f"{b._assign(lower=a._width)} <= (others => '0');"
-        return s
+        w = a._width
+        fill = a._access(upper=w-1, lower=w-1) if self._arith else "'0'"
+        return (f"{b._assign(upper=w-1)} <= {a._access()};\n"
+                f"{b._assign(lower=w)} <= (others => {fill});")
 class ShortenBlock(Block):
     """Block for signal width shorten"""
+    __slots__ = ('_arith', '_lower')
     def __init__(self, result, sig, arith, lower, **args):
         super().__init__(f"shorten {result._width} from {lower}", [sig], [result], **args)
         self._arith = arith
@@ -648,8 +729,170 @@ class ShortenBlock(Block):
         b = self._outputs[0]
         a = self._inputs[0]
         lo = self._lower
-        s = f"{b._assign()} <= {a._access(upper=b._width+lo-1, lower=lo)};\n"
-        return s
+        return f"{b._assign()} <= {a._access(upper=b._width+lo-1, lower=lo)};\n"
+
+
+_COMMENT_RE = re.compile(r"--[^\n]*")
+_WS_RE = re.compile(r"\s+")
+_ENTITY_RE = re.compile(r"(?:^|;)\s*entity\s+(\w+)\s+is\s+")
+_GENERIC_RE = re.compile(r"generic\s*\(")
+_PORT_RE = re.compile(r"port\s*\(")
+
+
+def _find_matching_paren(s, start):
+    """Finds the closing parenthesis for an opened parenthesis.
+    Jumps between the parentheses with str.find instead of checking each character.
+    The next opening and closing positions are kept, so every character is
+    scanned at most once per parenthesis type.
+
+    :s: string to search in
+    :start: position directly after the opening parenthesis
+    :returns: position of the matching closing parenthesis
+
+    """
+    level = 1
+    o = s.find("(", start)
+    c = s.find(")", start)
+    while True:
+        if c < 0:
+            raise Exception("Unbalanced parentheses in VHDL description")
+        if 0 <= o < c:
+            level += 1
+            o = s.find("(", o+1)
+        else:
+            level -= 1
+            if level == 0:
+                return c
+            c = s.find(")", c+1)
+
+
+def _parse_vhdl(text):
+    """Parses the first entity declaration of a VHDL description.
+
+    :text: content of the VHDL file
+    :returns: tuple (entity name, list of generics (name, type), list of ports (name, direction, type))
+
+    """
+    text = _WS_RE.sub(" ", _COMMENT_RE.sub(" ", text)).strip() # one line without comments
+    m = _ENTITY_RE.search(text)
+    if m is None:
+        raise Exception("No entity found in VHDL description")
+    vhdl_name = m.group(1)
+    pos = m.end()
+    generics, ports = "", ""
+    m = _GENERIC_RE.match(text, pos)
+    if m:
+        end = _find_matching_paren(text, m.end())
+        generics = text[m.end():end]
+        pos = text.find(";", end)
+        if pos < 0:
+            raise Exception("Missing ';' after the generic clause in VHDL description")
+        pos += 1
+        while pos < len(text) and text[pos].isspace():
+            pos += 1
+    m = _PORT_RE.match(text, pos)
+    if m:
+        end = _find_matching_paren(text, m.end())
+        ports = text[m.end():end]
+    parsed_generics = []
+    for generic in generics.split(";"):
+        parts = generic.split(":")
+        if len(parts) != 2:
+            continue
+        parsed_generics.append((parts[0].strip(), parts[1].strip()))
+    parsed_ports = []
+    for port in ports.split(";"):
+        parts = port.split(":")
+        if len(parts) != 2:
+            continue
+        name = parts[0].strip()
+        parts = parts[1].split()
+        parsed_ports.append((name, parts[0], " ".join(parts[1:])))
+    return vhdl_name, parsed_generics, parsed_ports
+
+
+def _portmap_expr(c, on):
+    """Port map entry of an entity instantiation.
+
+    :c: connected signal (or "clk")
+    :on: name of the port
+    :returns: VHDL port map association
+
+    """
+    if c == "clk":
+        return "clk"
+    if on.startswith("pin_") or c._internal_port == "in":
+        return f"{on} => {c._access()}"
+    return f"{on} => {c._assign()}"
+
+
+@lru_cache(maxsize=256)
+def _parse_vhdl_file(path, mtime):
+    """Cached parsing of a VHDL file (see _parse_vhdl).
+    The modification time is part of the key, so changed files are parsed again.
+
+    :path: path to the VHDL file
+    :mtime: modification time of the file
+    :returns: tuple (entity name, tuple of generics, tuple of ports)
+
+    """
+    with open(path) as f:
+        vhdl_name, generics, ports = _parse_vhdl(f.read())
+    return vhdl_name, tuple(generics), tuple(ports)
+
+def _vhdl_div(a, b):
+    """Integer division of VHDL ("/"), truncates toward zero."""
+    if b == 0:
+        raise Exception("Division by zero in VHDL port")
+    q = abs(a) // abs(b)
+    return q if (a < 0) == (b < 0) else -q
+
+
+_POW_MAX_BITS = 64 # bound for the results of "**", VHDL integers have 32 bits
+def _vhdl_pow(a, b):
+    """Exponentiation of VHDL ("**"), the result is limited to _POW_MAX_BITS."""
+    if b < 0:
+        raise Exception("Negative exponent in VHDL port")
+    if abs(a) > 1 and b * abs(a).bit_length() > _POW_MAX_BITS:
+        raise Exception(f"Exponentiation too large in VHDL port: {a}**{b}")
+    return a ** b
+
+
+_EXPR_OPS = {
+    ast.Add: lambda a, b: a + b,
+    ast.Sub: lambda a, b: a - b,
+    ast.Mult: lambda a, b: a * b,
+    ast.Div: _vhdl_div,
+    ast.Pow: _vhdl_pow,
+}
+
+
+def _eval_expr(node):
+    """Evaluates an integer expression tree (see _int_expr)."""
+    if isinstance(node, ast.Constant) and type(node.value) == int:
+        return node.value
+    if isinstance(node, ast.BinOp) and type(node.op) in _EXPR_OPS:
+        return _EXPR_OPS[type(node.op)](_eval_expr(node.left), _eval_expr(node.right))
+    if isinstance(node, ast.UnaryOp) and isinstance(node.op, (ast.USub, ast.UAdd)):
+        v = _eval_expr(node.operand)
+        return -v if isinstance(node.op, ast.USub) else v
+    raise Exception(f"Unsupported expression in VHDL port: {ast.dump(node)}")
+
+
+@lru_cache(maxsize=1024)
+def _int_expr(t):
+    """Evaluates an integer expression of a VHDL port range (e.g. "31" or "8+1-1").
+    Only integer constants and the operators + - * / ** are allowed,
+    "/" and "**" are evaluated with VHDL semantics (see _vhdl_div, _vhdl_pow).
+
+    :t: expression with all generics substituted
+    :returns: value of the expression
+
+    """
+    try:
+        return int(t)
+    except ValueError:
+        return _eval_expr(ast.parse(t, mode="eval").body)
 
 
 class Module:
@@ -674,10 +917,20 @@ class Module:
             Module.MODULE_STACK.append(self)
         self._determined = False
         self._forced_ports = []
-        self._ommited_ports = []
+        self._ommited_ports = {} # id -> value for values which are no ports, the stored value keeps its id unique
         self._entities = []
         self._module_name = name
         self._blocks = []
+        # id-sets for membership tests, the lists keep the order for the VHDL output
+        self._values_set = set()
+        self._forced_ports_set = set()
+        self._blocks_set = set()
+        self._const_cache = {} # (value, width, decimals) -> constant integer
+        # result of get_ports per mode, invalid as soon as values or ports change
+        self._ports_cache = {}
+        self._ports_dirty = True
+        # dependency graph of determine_all_widths, invalid as soon as values or width dependencies change
+        self._det_graph = None
     def add_value(self, val):
         """Add a value (signal) to the module.
 
@@ -685,7 +938,12 @@ class Module:
         :returns: None
 
         """
-        self.values.append(val)
+        if id(val) not in self._values_set:
+            self._values_set.add(id(val))
+            self.values.append(val)
+            self._ports_dirty = True
+            self._det_graph = None
+            self._determined = False
     def add_port(self, val, direction):
         """Add a value to the ports of the module.
         Usually, this is handled by the values themselves.
@@ -695,8 +953,10 @@ class Module:
         :returns: None
 
         """
-        if val not in self._forced_ports:
+        if id(val) not in self._forced_ports_set:
+            self._forced_ports_set.add(id(val))
             self._forced_ports.append((val, direction))
+            self._ports_dirty = True
     def add_block(self, block):
         """Add a block to the modules.
         See Block-class an its children.
@@ -705,7 +965,22 @@ class Module:
         :returns: None
 
         """
-        self._blocks.append(block)
+        if id(block) not in self._blocks_set:
+            self._blocks_set.add(id(block))
+            self._blocks.append(block)
+            self._ports_dirty = True
+    def batch_add_blocks(self, blocks):
+        """Add several blocks to the module at once.
+        Used for blocks created with defer_registration=True.
+
+        :blocks: iterable of blocks to add (in order)
+        :returns: None
+
+        """
+        new = [b for b in blocks if id(b) not in self._blocks_set]
+        self._blocks_set.update(id(b) for b in new)
+        self._blocks.extend(new)
+        self._ports_dirty = True
     def remove_port(self, val):
         """Remove a value from the ports of this module.
         This does not change the port properties of the value itself.
@@ -714,8 +989,9 @@ class Module:
         :returns: None
 
         """
-        if val not in self._forced_ports:
-            self._ommited_ports.append(val)
+        if id(val) not in self._forced_ports_set:
+            self._ommited_ports[id(val)] = val
+            self._ports_dirty = True
     def add_module(self, module, ent_name=None, signals={}, directions={}, behav=None):
         """Add another module to this module.
         Exising signals (values) can be directly connected by referencing them
@@ -731,8 +1007,10 @@ class Module:
 
         """
         if not ent_name:
-            ent_name = f"ent{Module.ENT_ID}"
-            Module.ENT_ID += 1
+            ent_id = Module.ENT_ID
+            ent_name = f"ent{ent_id}"
+            Module.ENT_ID = ent_id + 1
+        self._ports_dirty = True # connected signals change their port properties
         ports = module.get_ports()
         ports = ports[0] + ports[1]
         connections = []
@@ -776,188 +1054,179 @@ class Module:
         :returns: list of new signals for new ports
 
         """
-        content = " ".join(map(lambda x: x.strip(), filter(lambda x: len(x) > 0, map(lambda x: x if "--" not in x else x[:x.find("--")],open(path).read().split("\n")))))
-        while not content.strip().startswith("entity "):
-            content, _ = content[content.find(";")+2:], content[:content.find(";")]
-        content = content[content.find(" "):].strip()
-        vhdl_name = content[:content.find(" ")].strip()
-        content = content[content.find(" "):].strip()
-        content = content[content.find(" "):].strip()
-        if content.startswith("generic"):
-            content = content[content.find("(")+1:].strip()
-            level = 1
-            i = 0
-            while level > 0:
-                if content[i] == "(":
-                    level += 1
-                if content[i] == ")":
-                    level -= 1
-                i += 1
-            i -= 1
-            generics, content = content[:i], content[i:].strip()
-            content = content[content.find(";")+1:].strip()
-        else:
-            generics = ""
-        if content.startswith("port"):
-            content = content[content.find("(")+1:].strip()
-            level = 1
-            i = 0
-            while level > 0:
-                if content[i] == "(":
-                    level += 1
-                if content[i] == ")":
-                    level -= 1
-                i += 1
-            i -= 1
-            ports, content = content[:i], content[i:].strip()
-            ports = map(lambda x: x.strip(), ports.split(";"))
-        else:
-            ports = ""
-        generics = map(lambda x: x.strip(), generics.split(";"))
-        parsed_generics = []
-        for generic in generics:
-            parts = generic.split(":")
-            if len(parts) != 2:
-                continue
-            name = parts[0].strip()
-            sort = parts[1].strip()
-            parsed_generics.append((name, sort))
-        parsed_ports = []
-        for port in ports:
-            parts = port.split(":")
-            if len(parts) != 2:
-                continue
-            name = parts[0].strip()
-            parts = parts[1].strip().split(" ")
-            direction = parts[0].strip()
-            sort = " ".join(parts[1:]).strip()
-            parsed_ports.append((name, direction, sort))
-        m = VHDLModule(vhdl_name, parsed_generics, parsed_ports, generic_values)
+        vhdl_name, parsed_generics, parsed_ports = _parse_vhdl_file(path, os.path.getmtime(path))
+        m = VHDLModule(vhdl_name, list(parsed_generics), list(parsed_ports), generic_values)
         new_signals = self.add_module(m, ent_name, signals=signals, directions={n: d for n, d, _ in parsed_ports}, behav=behav)
         return new_signals
     def determine_signals(self):
         """Determines all values of this module"""
-        others = {}
         if not self._determined:
-            for v in self.values:
-                others = v.determine(others=others)
-            for v in self.values:
-                if not v in others:
-                    raise Exception(f"Integer width cannot be determined: {v._name}")
-                v.determine(others={v:others[v]})
+            self.determine_all_widths()
             self._determined = True
+    def determine_all_widths(self):
+        """Determines the widths of all integers connected to the values of this
+        module over their width dependencies. Known widths are propagated through
+        the dependency graph, each dependency is resolved exactly once.
+        The graph is kept until values or width dependencies are added.
+        Raises if a value of the module is left without width.
+
+        :returns: None
+
+        """
+        if self._det_graph is None or self._det_graph[0] != Integer._LINKS:
+            # collect all integers reachable from the values of the module
+            stack = [v for v in self.values if isinstance(v, Integer)]
+            seen = set(stack)
+            users = {} # v -> list of (x, o) with x._width == v._width + o
+            nodes = []
+            while len(stack) > 0:
+                x = stack.pop()
+                nodes.append(x)
+                if x._wd_sigs is None:
+                    continue
+                for v, o in zip(x._wd_sigs, x._wd_offs):
+                    users.setdefault(v, []).append((x, o))
+                    if v not in seen:
+                        seen.add(v)
+                        stack.append(v)
+            self._det_graph = (Integer._LINKS, nodes, users)
+        _, nodes, users = self._det_graph
+        # propagate known widths
+        known = deque(x for x in nodes if x._width)
+        while len(known) > 0:
+            v = known.popleft()
+            for x, o in users.get(v, []):
+                n = v._width + o
+                if not x._width:
+                    x._width = n
+                    known.append(x)
+                elif x._width != n:
+                    raise Exception(f"Integer width cannot be determined: {x._name}")
+        for v in self.values: # no VHDL with unresolved widths
+            if isinstance(v, Integer) and v._width is None:
+                raise Exception(f"Integer width cannot be determined: {v._name}")
     def get_ports(self, mode="VHDL"):
         """Get all ports of this module. This includes both forced ports over self.add_port,
         and values that have port properties.
 
+        The result is cached until values, ports, blocks or entities of the module change.
+
         :returns: tuple of lists: (list of ports, list of directions)
 
         """
+        if self._ports_dirty:
+            self._ports_cache.clear()
+            self._ports_dirty = False
+        elif mode in self._ports_cache:
+            return self._ports_cache[mode]
         self.determine_signals()
-        ports_all = []
+        ports_all = set() # ids of the values with port properties
         ports = ([], [])
         for v in self.values:
-            if v in self._ommited_ports:
+            if id(v) in self._ommited_ports:
                 continue
             if v._accessed == 0: # out port
                 n, t = v.init(mode=mode)[-1]
                 ports[0].append((f"pout_{n}", v))
-                ports_all.append(v)
+                ports_all.add(id(v))
             elif v._assigned == 0: # in port
                 n, t = v.init(mode=mode)[0]
                 ports[1].append((f"pin_{n}", v))
-                ports_all.append(v)
+                ports_all.add(id(v))
         for v,d in self._forced_ports:
-            if v not in ports_all:
+            if id(v) not in ports_all:
                 if d == 'out':
                     n, t = v.init(mode=mode)[-1]
                 else:
                     n, t = v.init(mode=mode)[0]
                 ports[0 if d == "out" else 1].append((f"p{'out' if d == 'out' else 'in'}_{n}", v))
+        self._ports_cache[mode] = ports
         return ports
     def generateVHDL(self):
         """Generates a VHDL description of this module in file "module.vhd".  """
-        if len([v._name for v in self.values if v._width == None]) > 0:
+        if any(v._width is None for v in self.values):
             self.determine_signals()
         ports = []
-        signals = ""
-        content = ""
-        ports_handled = []
+        signals = [] # parts of the signal declarations
+        content = [] # parts of the architecture body
+        generated = [] # logic of the values, follows the port assignments
+        registers = []
+        ports_handled = set() # ids of the values already declared as ports
+        ommited = self._ommited_ports
+        # one pass over the values for ports, signals, logic and buffers
         for v in self.values:
-            if v in self._ommited_ports:
-                continue
-            if v._accessed == 0: # out port
-                n, t = v.init()[-1]
-                ports.append(f"pout_{n} : out {t}")
-                content += f"pout_{n} <= {n};\n"
-                ports_handled.append(v)
-            elif v._assigned == 0: # in port
-                n, t = v.init()[0]
-                ports.append(f"pin_{n} : in {t}")
-                content += f"{n} <= pin_{n};\n"
-                ports_handled.append(v)
+            inits = v.init()
+            if id(v) not in ommited:
+                if v._accessed == 0: # out port
+                    n, t = inits[-1]
+                    ports.append(f"pout_{n} : out {t}")
+                    content.append(f"pout_{n} <= {n};\n")
+                    ports_handled.add(id(v))
+                elif v._assigned == 0: # in port
+                    n, t = inits[0]
+                    ports.append(f"pin_{n} : in {t}")
+                    content.append(f"{n} <= pin_{n};\n")
+                    ports_handled.add(id(v))
+            for n, t in inits:
+                signals.append(f"signal {n} : {t};\n")
+            g = v.generate()
+            if len(g) > 0:
+                generated.append(g + "\n")
+            b = v._buffer_access # names of all buffer stages, b0 is assigned by the logic
+            for i in range(v._buffer):
+                registers.append(f"{b[i+1]} <= {b[i]};\n")
         for v,d in self._forced_ports:
-            if not v in ports_handled:
+            if id(v) not in ports_handled:
                 if d == 'out':
                     n, t = v.init()[-1]
                 else:
                     n, t = v.init()[0]
                 ports.append(f"p{'out' if d == 'out' else 'in'}_{n} : {'out' if d == 'out' else 'in'} {t}")
                 if d == 'out':
-                    content += f"pout_{n} <= {n}"
+                    content.append(f"pout_{n} <= {n}")
                 else:
-                    content += f"{n} <= pin_{n}"
-                ports_handled.append(v)
+                    content.append(f"{n} <= pin_{n}")
+                ports_handled.add(id(v))
         ports.append("clk : in std_logic")
-        for v in self.values:
-            for n, t in v.init(mode="VHDL"):
-                signals += f"signal {n} : {t};\n"
-        for v in self.values:
-            s = v.generate()
-            if len(s) > 0:
-                content += v.generate() + "\n"
+        content.extend(generated)
         ## buffers
-        buffers = 0
-        for v in self.values:
-            for i in range(v._buffer):
-                buffers += 1
-        if buffers > 0:
-            content += f"\n\n------------\n-- REGISTERS\n------------\n\n"
-            content += "\nsync: process(clk)\nbegin\nif rising_edge(clk) then\n"
-            for v in self.values:
-                for i in range(v._buffer):
-                    content += f"{v._assign(buffer=i+1)} <= {v._access(buffer=i)};\n"
-            content += "end if;\nend process;\n"
+        if len(registers) > 0:
+            content.append(f"\n\n------------\n-- REGISTERS\n------------\n\n")
+            content.append("\nsync: process(clk)\nbegin\nif rising_edge(clk) then\n")
+            content.extend(registers)
+            content.append("end if;\nend process;\n")
         ## blocks
-        content += "\n\n---------\n-- BLOCKS\n---------\n\n"
+        content.append("\n\n---------\n-- BLOCKS\n---------\n\n")
         for block in self._blocks:
-            content += f"-- {block._name}\n{block.generateVHDL()}\n\n"
+            content.append(f"-- {block._name}\n{block.generateVHDL()}\n\n")
         ## entities
         for m, n, gs, cs, beh in self._entities:
             if beh == None:
-                content += f"{n}: entity work.{m._module_name}\n"
+                content.append(f"{n}: entity work.{m._module_name}\n")
             else:
-                content += f"{n}: entity work.{m._module_name}({beh})\n"
+                content.append(f"{n}: entity work.{m._module_name}({beh})\n")
             if len(gs) > 0:
-                content += f"generic map ()"
-            ts = lambda c, on: on.startswith("pin_") or c._internal_port=="in"
-            content += f"port map ("
-            content += f"{', '.join([f'{on} => {c._access() if ts(c,on) else c._assign()}' if c != 'clk' else 'clk' for c,on in cs])}"
+                content.append(f"generic map ()")
+            content.append(f"port map ({', '.join([_portmap_expr(c, on) for c, on in cs])}")
             if type(m) != VHDLModule:
-                content += ", clk => clk"
-            content += ");\n"
-        if not os.path.exists(os.path.join(os.getcwd(), Module.OUTPATH)):
-            print(f"Creating output directory {Module.OUTPATH}")
-            os.mkdir(os.path.join(os.getcwd(), Module.OUTPATH))
-        print(f"Writing file {Module.OUTPATH}{self._module_name}.vhd")
-        f = open(str(os.path.join(os.getcwd(), Module.OUTPATH, f"{self._module_name}.vhd")), "w")
+                content.append(", clk => clk")
+            content.append(");\n")
+        outpath = Module.OUTPATH
+        outdir = os.path.join(os.getcwd(), outpath)
+        if not os.path.isdir(outdir):
+            print(f"Creating output directory {outpath}")
+            os.makedirs(outdir, exist_ok=True)
+        print(f"Writing file {outpath}{self._module_name}.vhd")
         ts = ";\n"
-        f.write("library IEEE;\nuse IEEE.std_logic_1164.ALL;\nuse IEEE.numeric_std.ALL;\n\n")
-        f.write(f"entity {self._module_name} is\nport (\n{ts.join(ports)});\nend {self._module_name};\n\n")
-        f.write(f"architecture beh of {self._module_name} is\n{signals}\nbegin\n")
-        f.write(content)
-        f.write("\nend beh;")
-        f.close()
+        # the whole file is assembled first and written at once
+        text = "".join([
+            "library IEEE;\nuse IEEE.std_logic_1164.ALL;\nuse IEEE.numeric_std.ALL;\n\n",
+            f"entity {self._module_name} is\nport (\n{ts.join(ports)});\nend {self._module_name};\n\n",
+            f"architecture beh of {self._module_name} is\n{''.join(signals)}\nbegin\n",
+            *content,
+            "\nend beh;"])
+        with open(os.path.join(outdir, f"{self._module_name}.vhd"), "w") as f:
+            f.write(text)
         Module.MODULE_STACK.pop()
 class VHDLModule(Module):
     """Class for modules based on VHDL descriptions."""
@@ -967,6 +1236,9 @@ class VHDLModule(Module):
         self._generics = generics
         self._generic_values = generic_values
     def get_ports(self):
+        # ports and generics of the entity are fixed, the ports are built once per instance
+        if self._ports_cache:
+            return self._ports_cache["VHDL"]
         ports = [[],[]] # list with in, out ports, name, signal
         for n, d, t in self._ports:
             if t.startswith("std_logic_vector") and t.endswith("downto 0)"):
@@ -974,9 +1246,10 @@ class VHDLModule(Module):
                 t = t[:t.find("downto")].strip()
                 for g in self._generic_values:
                     t = t.replace(g, str(self._generic_values[g]))
-                width = eval(t)+1
+                width = _int_expr(t) + 1
                 t = Integer(width=width, dummy=True)
             ports[0 if d=='in' else 1].append((n, t))
+        self._ports_cache["VHDL"] = ports
         return ports
 
 
@@ -5,97 +5,129 @@ from computationcoding.no_add import no_add_MPA as get_adds
 from computationcoding.csd_conv import to_csd
 import csv
 
-def get_shifts(value, total_bits=16, decimal_bits=8):
+def get_shifts(value, total_bits=16, decimal_bits=8, verbose=False):
     """
-    Computes the minimal set of shifts for a given fixed-point number and prints detailed shift info.
+    Computes the minimal set of shifts for a given fixed-point number and optionally prints detailed shift info.
 
     :param value: The floating-point value to convert
     :param total_bits: Total bit width of the fixed-point representation
     :param decimal_bits: Number of fractional bits
+    :param verbose: Print the CSD representation and every shift
     :return: List of shifts (position, sign, power of 2, shifts needed)
     """
     shifts = []
     csd = to_csd(value, total_bits - decimal_bits, total_bits)
-    print(f"CSD Representation for {value}: {csd}")
-    for i, bit in enumerate(csd):
-        if bit != 0:
-            shift_position = total_bits - decimal_bits - i - 1
-            abs_position = abs(shift_position)
-            power_of_2 = 2 ** abs_position
-            shifts_needed = abs_position
-            sign = bit > 0
-            shifts.append((abs_position, sign, power_of_2, shifts_needed))
-            print(f"Value: {value}, Abs Position: {abs_position}, Power of 2: {power_of_2}, Shifts Needed: {shifts_needed}, Sign: {'+' if sign else '-'}")
+    if verbose:
+        print(f"CSD Representation for {value}: {csd}")
+    # bit i of the masks is set for a nonzero digit at index i of the csd
+    pos_mask = sum(1 << i for i, bit in enumerate(csd) if bit > 0)
+    mask = pos_mask | sum(1 << i for i, bit in enumerate(csd) if bit < 0)
+    while mask:
+        lsb = mask & -mask
+        mask ^= lsb
+        i = lsb.bit_length() - 1
+        abs_position = abs(total_bits - decimal_bits - i - 1)
+        sign = bool(pos_mask & lsb)
+        shifts.append((abs_position, sign, 1 << abs_position, abs_position))
+        if verbose:
+            print(f"Value: {value}, Abs Position: {abs_position}, Power of 2: {1 << abs_position}, Shifts Needed: {abs_position}, Sign: {'+' if sign else '-'}")
     return shifts
 
-def p2d_decomp(M, S, E=2, sqnr_target=48, verbose=False):
+def get_shifts_batch(values, total_bits=16, decimal_bits=8):
+    """
+    Computes the shifts of get_shifts for several fixed-point numbers at once.
+    Factor matrices repeat their entries a lot, so every distinct value is converted only once.
+
+    :param values: Array of floating-point values to convert
+    :param total_bits: Total bit width of the fixed-point representation
+    :param decimal_bits: Number of fractional bits
+    :return: List with the list of shifts (position, sign, power of 2, shifts needed) for each value
+    """
+    uniq, inv = np.unique(np.asarray(values, dtype=np.float64).ravel(), return_inverse=True)
+    uniq_shifts = [get_shifts(value, total_bits, decimal_bits) for value in uniq.tolist()]
+    return [list(uniq_shifts[i]) for i in inv.tolist()]
+
+def p2d_decomp(M, S, E=2, sqnr_target=48, verbose=False, total_bits=16, decimal_bits=8):
     def slice_mat(M, S):
         return [M[:, sum(S[:i-1]):sum(S[:i])] for i in range(1, len(S)+1)]
 
+    log = print if verbose else (lambda *a, **k: None) # diagnostic output
     mats = slice_mat(M, S)
     # Print each slice and its entries
     for i, mat in enumerate(mats):
-        print(f"Slice {i+1}:")
-        print(mat)
-        print()
+        log(f"Slice {i+1}:")
+        log(mat)
+        log()
 
     factors = [[np.eye(*mats[s].shape)] for s in range(len(S))]
     approxes = [np.eye(*mats[s].shape) for s in range(len(S))]
+    # approximation of the full matrix, the slices are written into their column slabs
+    offs = np.cumsum([0] + list(S))
+    approx_full = np.concatenate(approxes, axis=1) # slabs of identity updates stay untouched
+    one_shifts = get_shifts_batch([1.0], total_bits, decimal_bits)[0] # shifts of every row of an identity factor
     snr = 0
     p = 0
     adds = 0
-    combined_data = []
 
-    while snr < sqnr_target:
-        p += 1
-        for s in range(len(S)):
-            W = dp2d(mats[s].T, approxes[s].T, E).T
-            approxes[s] = W @ approxes[s]
-            factors[s].append(W)
-            if verbose:
-                print(p, s, SNRmat(mats[s], approxes[s]))
-            adds += get_adds(W)
-            # Collect shifts data
-            slice_shifts_data = []
-            for row_idx, row in enumerate(W):
-                row_shifts = []
-                for co_idx, val in enumerate(row):
-                    if val != 0:
-                        print(s, len(factors[s]), row_idx, co_idx)
-                        shifts = get_shifts(val)
-                        row_shifts.extend(shifts)
-                        print()
-                slice_shifts_data.append(row_shifts)
-                combined_data.append((s+1, len(factors[s]), row_shifts))  # Add slice index, factor index, and shifts data
-        snr = SNRmat(M, np.concatenate(approxes, axis=1))
-        if verbose:
-            print(p, snr, adds)
-        if p > 200:
-            return None
-
-    # Print the decomposed matrix of each slice
-    for i, mat in enumerate(approxes):
-        print(f"Decomposed matrix of slice {i+1}:")
-        print(mat)
-        print()
-
-    # Print each factor matrix
-    for i, factor_list in enumerate(factors):
-        print(f"Factor matrices of slice {i+1}:")
-        for j, factor in enumerate(factor_list):
-            print(f"Factor {j+1}:")
-            print(factor)
-            print()
-
-    # Save combined data to CSV
-    with open("combined_data.csv", "w", newline='') as csvfile:
+    # Save combined data to CSV, every row is written directly
+    csvfile = open("combined_data.csv", "w", newline='')
+    try:
         csvwriter = csv.writer(csvfile)
         csvwriter.writerow(["slice_idx", "factor_idx", "shifts"])
-        for row in combined_data:
-            shifts_str = ";".join([f"({pos},{int(sign)},{pow2},{shifts})" for pos, sign, pow2, shifts in row[2]])
-            if len(row[2]) < 1:
-                print(f"Warning: No shift data for slice {row[0]} factor {row[1]}")
-            csvwriter.writerow([row[0], row[1], shifts_str])
+        while snr < sqnr_target:
+            p += 1
+            for s in range(len(S)):
+                W = dp2d(mats[s].T, approxes[s].T, E).T
+                identity = W.shape[0] == W.shape[1] and np.array_equal(W, np.eye(W.shape[0]))
+                if not identity: # the identity does not change the approximation
+                    approxes[s] = W @ approxes[s]
+                    approx_full[:, offs[s]:offs[s+1]] = approxes[s]
+                factors[s].append(W)
+                if verbose:
+                    log(p, s, SNRmat(mats[s], approxes[s]))
+                adds += get_adds(W)
+                # Collect shifts data
+                if identity:
+                    log(s, len(factors[s]), "identity factor")
+                    slice_shifts_data = [list(one_shifts) for _ in range(W.shape[0])]
+                else:
+                    slice_shifts_data = [[] for _ in range(W.shape[0])]
+                    ri, ci = np.nonzero(W)
+                    vals = W[ri, ci]
+                    entry_shifts = get_shifts_batch(vals, total_bits, decimal_bits)
+                    for row_idx, co_idx, val, val_shifts in zip(ri.tolist(), ci.tolist(), vals.tolist(), entry_shifts):
+                        if verbose:
+                            log(s, len(factors[s]), row_idx, co_idx)
+                            get_shifts(val, total_bits, decimal_bits, verbose=True)
+                            log()
+                        slice_shifts_data[row_idx].extend(val_shifts)
+                for row_shifts in slice_shifts_data: # slice index, factor index, and shifts data
+                    if not row_shifts: # rows without shifts are not written
+                        log(f"Warning: No shift data for slice {s+1} factor {len(factors[s])}")
+                        continue
+                    shifts_str = ";".join(["(%d,%d,%d,%d)" % (pos, sign, pow2, shifts) for pos, sign, pow2, shifts in row_shifts])
+                    csvwriter.writerow([s+1, len(factors[s]), shifts_str])
+            snr = SNRmat(M, approx_full)
+            log(p, snr, adds)
+            if p > 200:
+                return None
+    finally:
+        csvfile.close()
+
+    if verbose:
+        # Print the decomposed matrix of each slice
+        for i, mat in enumerate(approxes):
+            log(f"Decomposed matrix of slice {i+1}:")
+            log(mat)
+            log()
+
+        # Print each factor matrix
+        for i, factor_list in enumerate(factors):
+            log(f"Factor matrices of slice {i+1}:")
+            for j, factor in enumerate(factor_list):
+                log(f"Factor {j+1}:")
+                log(factor)
+                log()
 
     return factors, snr, adds, p
 
@@ -0,0 +1,38 @@
+import numpy as np
+import pytest
+
+import csd
+from csd import to_csd_batch
+
+WIDTHS = [(8, 16), (2, 10)] # (integer bits, total bits) of p2d and lzd
+
+
+def edge_values(wd, w):
+    """Values at the digit thresholds, next to them, and beyond the width limit."""
+    ties = np.ldexp(2/3, np.arange(wd-w, wd))
+    vals = np.concatenate((ties, np.nextafter(ties, np.inf), np.nextafter(ties, 0),
+                           np.ldexp(1., np.arange(wd-w, wd)), [0., 0.75, 1.5, 2.**wd, 3.**wd],
+                           np.random.default_rng(0).uniform(-2.**(wd-1), 2.**(wd-1), 200)))
+    return np.concatenate((vals, -vals))
+
+
+@pytest.mark.parametrize("wd, w", WIDTHS)
+def test_to_csd_numpy_matches_numba(wd, w, monkeypatch):
+    vals = edge_values(wd, w)
+    compiled = to_csd_batch(vals, wd, w)
+    monkeypatch.setattr(csd, "to_csd_batch_nb", None)
+    np.testing.assert_array_equal(to_csd_batch(vals, wd, w), compiled)
+
+
+@pytest.mark.parametrize("wd, w", WIDTHS)
+def test_to_csd_reference(wd, w):
+    vals = edge_values(wd, w)
+    vals = vals[np.abs(vals) <= np.ldexp(4/3, wd-1)] # representable range
+    digits = to_csd_batch(vals, wd, w)
+    # nonadjacent digits
+    assert not np.any((digits[:, 1:] != 0) & (digits[:, :-1] != 0))
+    # rounded to the last digit, ties at the thresholds round towards zero
+    recon = digits @ np.ldexp(1., wd-1-np.arange(w))
+    assert np.all(np.abs(vals-recon) <= np.ldexp(2/3, wd-w))
+    ties = np.ldexp(2/3, np.arange(wd-w, wd))
+    np.testing.assert_array_equal(to_csd_batch(ties[:1], wd, w), np.zeros((1, w)))
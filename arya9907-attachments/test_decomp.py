@@ -0,0 +1,19 @@
+import numpy as np
+import pytest
+
+pytest.importorskip("computationcoding")
+from decomp import decomp_p2d, slice_mat
+
+
+def test_decomp_p2d_integer_matrix():
+    """Integer matrices are decomposed like their float counterparts."""
+    M = np.array([[3, -1, 2, 0],
+                  [1, 4, -2, 1],
+                  [-3, 2, 1, 2],
+                  [0, 1, -1, 3]])
+    S = [2, 2]
+    r = decomp_p2d(M.shape, M, slice_mat(M, S), 2, S)
+    assert r is not None
+    factors, snr, adds, p = r
+    assert snr >= 48
+    assert all(f.dtype == np.float64 for fs in factors for f in fs)